@@ -14,6 +14,8 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 
 import abc
 
+from packet_base import PacketBase
+
 
 class BluetoothBase(abc.ABC):
     @abc.abstractmethod
@@ -35,3 +37,17 @@ class BluetoothBase(abc.ABC):
     @abc.abstractmethod
     def read(self, count: int) -> bytes:
         pass
+
+    def read_packet(self) -> bytes:
+        """
+        read one complete packet: start marker, 16 bit little endian size and size + 1 more bytes
+
+        backends which can receive a whole packet at once should override this, by default
+        the header is read first and then the rest of the packet
+        """
+        header = self.read(3)
+        if len(header) < 3 or header[0] != PacketBase.START_OF_PACKET:
+            return header
+
+        size = ((header[2] & 0xff) << 8) | (header[1] & 0xff)
+        return header + self.read(size + 1)
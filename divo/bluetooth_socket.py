@@ -15,19 +15,28 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 import socket
 from typing import Optional
 
+from loguru import logger
+
 from bluetooth_base import BluetoothBase
 from exceptions import NotConnectedException
+from packet_base import PacketBase
 
 
 class BluetoothSocket(BluetoothBase):
     """
     Bluetooth connection using native Bluetooth socket support.
     """
+    # receive up to this many bytes at once, enough for any response of the Pixoo
+    RECV_SIZE = 1024
+
     def __init__(self, mac_address, **kwargs):
         self.mac_address = mac_address
         self.sock = None
         self.timeout = kwargs.get("socket_timeout", None)  # type: Optional[float]
 
+        # received data which wasn't consumed yet by read_packet()
+        self.rx_buf = bytearray()
+
     def connect(self):
         self.sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
         self.sock.connect((self.mac_address, 1))
@@ -51,4 +60,43 @@ class BluetoothSocket(BluetoothBase):
         if self.sock is None:
             raise NotConnectedException("tried to read data")
 
+        if self.rx_buf:
+            data = bytes(self.rx_buf[:count])
+            del self.rx_buf[:count]
+            return data
+
         return self.sock.recv(count)
+
+    def read_packet(self) -> bytes:
+        if self.sock is None:
+            raise NotConnectedException("tried to read data")
+
+        # RFCOMM is a stream, so a single recv usually returns a whole packet, but it may also
+        # return only part of it or the start of the next one
+        buf = self.rx_buf
+        while True:
+            if buf and buf[0] != PacketBase.START_OF_PACKET:
+                start = buf.find(PacketBase.START_OF_PACKET)
+                if start < 0:
+                    break
+
+                # drop the garbage but keep the packets queued behind it
+                logger.error(f"skipping garbage: {bytes(buf[:start])}")
+                del buf[:start]
+
+            if len(buf) >= 3:
+                size = ((buf[2] & 0xff) << 8) | (buf[1] & 0xff)
+                if len(buf) >= size + 4:
+                    packet = bytes(buf[:size + 4])
+                    del buf[:size + 4]
+                    return packet
+
+            data = self.sock.recv(self.RECV_SIZE)
+            if not data:
+                break
+            buf += data
+
+        # garbage or connection closed, hand out whatever we got
+        packet = bytes(buf)
+        buf.clear()
+        return packet
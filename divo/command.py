@@ -44,10 +44,22 @@ class Command(CommandBase):
 
 
 # when one of the following commands is sent the device doesn't send back a response
-without_response = [
+without_response = frozenset({
     Command.SEND_APP_NEWEST_TIME,
     Command.SET_SLEEP_COLOR,
-]
+})
+
+# payload size of commands which always send the same amount of data
+payload_size = {
+    Command.SET_TIME: 8,
+    Command.SET_SYSTEM_COLOR: 3,
+    Command.SEND_APP_NEWEST_TIME: 1,
+    Command.SET_24_HOUR: 1,
+    Command.GET_BOX_MODE: 0,
+    Command.SET_SYSTEM_BRIGHTNESS: 1,
+    Command.SET_GAME: 2,
+    Command.SET_SLEEP_COLOR: 3,
+}
 
 
 class CommandParser(CommandParserBase):
@@ -12,17 +12,16 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
-from math import ceil, log
-from typing import List
+import sys
+from typing import List, NamedTuple
 
-from colorconsole import terminal
+import numpy as np
 
 
-class Color:
-    def __init__(self, r: int, g: int, b: int):
-        self.r = r
-        self.g = g
-        self.b = b
+class Color(NamedTuple):
+    r: int
+    g: int
+    b: int
 
     def __repr__(self):
         return f"Color({self.r}, {self.g}, {self.b})"
@@ -38,50 +37,126 @@ class Palette:
     def clear(self):
         self.palette.clear()
 
+    def to_array(self) -> np.ndarray:
+        return np.array(self.palette, dtype=np.uint8).reshape(-1, 3)
+
     def bits_per_pixel(self) -> int:
-        return ceil(log(len(self.palette), 2))
+        # a single color still needs one bit per pixel
+        n = len(self.palette)
+        return 1 if n <= 1 else (n - 1).bit_length()
 
     def print_to(self, screen: "Screen"):
         screen.print_palette(self.palette)
 
 
+def pack_indices(idx: np.ndarray, bpp: int) -> bytes:
+    """
+    pack palette indices into the Pixoo image bit stream, the first pixel going into the lowest bits
+
+    :param idx: palette indices, flattened in row-major order
+    :param bpp: bits per pixel
+    :return: packed image data
+    """
+    idx = np.ascontiguousarray(idx, dtype=np.uint8).ravel()
+    if bpp == 8:
+        return idx.tobytes()
+
+    if bpp in (1, 2, 4):
+        # several whole pixels per byte, combine them with one weighted sum per byte
+        per_byte = 8 // bpp
+        pad = -len(idx) % per_byte
+        if pad:
+            idx = np.concatenate((idx, np.zeros(pad, dtype=np.uint8)))
+        weights = np.array([1 << (i * bpp) for i in range(per_byte)], dtype=np.uint8)
+        return (idx.reshape(-1, per_byte) * weights).sum(axis=1, dtype=np.uint8).tobytes()
+
+    # pixels cross byte boundaries, go through the single bits
+    bits = (idx[:, None] >> np.arange(bpp, dtype=np.uint8)) & 1
+    return np.packbits(bits.ravel(), bitorder="little").tobytes()
+
+
 class ImageBuffer:
     def __init__(self, **kwargs):
         self.width = kwargs.get("width", 16)
         self.height = kwargs.get("height", self.width)
         self.default_value = kwargs.get("default_value", Color(0, 0, 0))
 
-        self.buf = [[self.default_value]*self.width for _ in range(self.height)]
+        # one contiguous rgb frame, indexed [y, x, channel]
+        self.buf = np.full((self.height, self.width, 3), self.default_value, dtype=np.uint8)
 
     def set(self, x: int, y: int, color: Color):
-        self.buf[y][x] = color
+        self.buf[y, x] = color
 
-    def print_to(self, screen: 'Screen'):
-        for row in self.buf:
-            for pixel in row:
-                screen.print_color(pixel)
+    def quantize(self, palette: Palette) -> np.ndarray:
+        """
+        map every pixel to the nearest color of the given palette
+
+        :param palette: palette to encode the image with
+        :return: uint8 array of palette indices with shape (height, width)
+        """
+        # numba is only needed when encoding frames, don't load it on import
+        import kernels
+
+        return kernels.quantize(self.buf, palette.to_array())
+
+    def encode(self, palette: Palette) -> bytes:
+        """
+        encode image as palette indices packed with the palette's bits per pixel
 
-            screen.line_end()
+        :param palette: palette to encode the image with
+        :return: image data as used in SET_BOX_COLOR
+        """
+        return pack_indices(self.quantize(palette), palette.bits_per_pixel())
+
+    def encode_packet(self, palette: Palette, header: bytes, end: int) -> bytes:
+        """
+        encode image like encode() and frame it into a packet in one pass over the pixels
+
+        :param palette: palette to encode the image with
+        :param header: everything in front of the image data, starting with the start marker
+        :param end: end marker
+        :return: complete packet with checksum
+        """
+        import kernels
+
+        packet = kernels.encode_frame(self.buf, palette.to_array(), palette.bits_per_pixel(),
+                                      np.frombuffer(header, dtype=np.uint8), end)
+        return packet.tobytes()
+
+    def print_to(self, screen: 'Screen'):
+        screen.print_rows(self.buf.reshape(self.height, -1).tolist())
 
 
 class Screen:
+    # xterm 24 bit color escape sequences
+    FG_COLOR = "\x1b[38;2;%d;%d;%dm"
+    RESET = "\x1b[0m"
+
     def __init__(self, **kwargs):
-        self.screen = terminal.get_terminal(conEmu=False)
         self.block = kwargs.get("block", "██")
+        self._fmt = (self.FG_COLOR + self.block).__mod__
 
     def print_color(self, color: Color):
-        self.screen.xterm24bit_set_fg_color(color.r, color.g, color.b)
-        print(self.block, end="")
-        self.screen.reset()
+        sys.stdout.write(self._fmt(color) + self.RESET)
 
     @staticmethod
     def line_end():
         print()
 
+    def print_rows(self, rows: List[List[int]]):
+        """
+        print rows of pixels at once instead of doing terminal calls per pixel
+
+        :param rows: one flat list of r, g, b values per row
+        """
+        if not rows:
+            return
+
+        # format a whole row in one go
+        row_fmt = (self.FG_COLOR + self.block) * (len(rows[0]) // 3) + self.RESET + "\n"
+        sys.stdout.write("".join(row_fmt % tuple(row) for row in rows))
+
     def print_palette(self, palette: List[Color]):
-        print(f"Palette ({len(palette)}):")
-        for i, color in enumerate(palette):
-            print(i, end=" ")
-            self.print_color(color)
-            print("", color)
-        print("\n")
+        lines = [f"Palette ({len(palette)}):"]
+        lines += [f"{i} {self._fmt(color)}{self.RESET} {color!r}" for i, color in enumerate(palette)]
+        sys.stdout.write("\n".join(lines) + "\n\n\n")
@@ -0,0 +1,96 @@
+"""
+This file is part of divo (https://github.com/spezifisch/divo).
+Copyright (c) 2021 spezifisch (https://github.com/spezifisch).
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation.
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(cache=True)
+def _nearest(r: int, g: int, b: int, palette: np.ndarray) -> int:
+    best = 0
+    best_dist = 1 << 30
+    for i in range(palette.shape[0]):
+        dr = r - int(palette[i, 0])
+        dg = g - int(palette[i, 1])
+        db = b - int(palette[i, 2])
+        dist = dr * dr + dg * dg + db * db
+        if dist < best_dist:
+            best_dist = dist
+            best = i
+    return best
+
+
+@njit(parallel=True, cache=True)
+def quantize(frame: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """
+    map each pixel to the index of the nearest palette color (squared rgb distance)
+
+    :param frame: uint8 array of shape (height, width, 3)
+    :param palette: uint8 array of shape (n, 3)
+    :return: uint8 array of palette indices with shape (height, width)
+    """
+    height, width, _ = frame.shape
+    out = np.empty((height, width), np.uint8)
+    for y in prange(height):
+        for x in range(width):
+            out[y, x] = _nearest(int(frame[y, x, 0]), int(frame[y, x, 1]), int(frame[y, x, 2]), palette)
+    return out
+
+
+@njit(cache=True)
+def encode_frame(frame: np.ndarray, palette: np.ndarray, bpp: int, header: np.ndarray, end: int) -> np.ndarray:
+    """
+    build a complete packet from a frame in a single pass: quantize, pack bits and checksum
+
+    :param frame: uint8 array of shape (height, width, 3)
+    :param palette: uint8 array of shape (n, 3)
+    :param bpp: bits per pixel, the pixels are packed lowest bits first
+    :param header: uint8 array with everything in front of the image data, starting with the start marker
+    :param end: end marker
+    :return: uint8 array with the packet
+    """
+    height, width, _ = frame.shape
+    image_size = (height * width * bpp + 7) // 8
+    out = np.empty(len(header) + image_size + 3, np.uint8)
+
+    # checksum covers everything after the start marker
+    checksum = 0
+    out[0] = header[0]
+    for i in range(1, len(header)):
+        out[i] = header[i]
+        checksum += header[i]
+
+    pos = len(header)
+    bits = 0  # pixel bits not written yet
+    bit_count = 0
+    for y in range(height):
+        for x in range(width):
+            bits |= _nearest(int(frame[y, x, 0]), int(frame[y, x, 1]), int(frame[y, x, 2]), palette) << bit_count
+            bit_count += bpp
+            while bit_count >= 8:
+                out[pos] = bits & 0xff
+                checksum += bits & 0xff
+                pos += 1
+                bits >>= 8
+                bit_count -= 8
+    if bit_count > 0:
+        out[pos] = bits
+        checksum += bits
+        pos += 1
+
+    checksum &= 0xffff
+    out[pos] = checksum & 0xff
+    out[pos + 1] = checksum >> 8
+    out[pos + 2] = end
+    return out
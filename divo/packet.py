@@ -12,13 +12,28 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
-from typing import Optional, Union, Any
+import struct
+from functools import lru_cache
+from typing import Optional, Union, Any, Callable
 
 from command_base import CommandBase, CommandParserBase
 from exceptions import PacketParsingError, PacketChecksumError
 from packet_base import PacketBase
 
 
+_HEADER = struct.Struct("<BHB")  # start marker, size, command
+_TRAILER = struct.Struct("<HB")  # checksum, end marker
+
+
+def checksum(data: Union[bytes, memoryview]) -> int:
+    """
+    packets are protected by a 16 bit sum over all their bytes, there's no CRC
+
+    summing bytes runs entirely in C, which is as fast as a lookup table would be for our packet sizes
+    """
+    return sum(data) & 0xffff
+
+
 class Packet(PacketBase):
     @classmethod
     def build(cls, cmd: CommandBase, payload: Optional[Union[bytes, int]] = None) -> bytes:
@@ -26,24 +41,50 @@ class Packet(PacketBase):
             payload = bytes([payload])
         elif payload is None:
             payload = b''
-            
-        # add header
-        size = len(payload) + 3
-        size_lo = size & 0xff
-        size_hi = (size >> 8) & 0xff
-        command = cmd.value & 0xff
-        packet = bytes([cls.START_OF_PACKET, size_lo, size_hi, command])
-        
-        # add payload
-        packet += payload
-        
-        # add checksum and end marker
-        checksum = sum(packet[1:]) & 0xffff
-        checksum_lo = checksum & 0xff
-        checksum_hi = (checksum >> 8) & 0xff
-        packet += bytes([checksum_lo, checksum_hi, cls.END_OF_PACKET])
-        
-        return packet
+
+        header = cls.header(cmd, len(payload))
+
+        # checksum covers everything after the start marker
+        packet_checksum = (checksum(memoryview(header)[1:]) + checksum(payload)) & 0xffff
+        return header + payload + _TRAILER.pack(packet_checksum, cls.END_OF_PACKET)
+
+    @classmethod
+    def header(cls, cmd: CommandBase, payload_size: int) -> bytes:
+        """start marker, size and command id of a packet with the given payload size"""
+        return _HEADER.pack(cls.START_OF_PACKET, (payload_size + 3) & 0xffff, cmd.value & 0xff)
+
+    @classmethod
+    @lru_cache(maxsize=512)
+    def build_cached(cls, cmd: CommandBase, payload: Optional[bytes] = None) -> bytes:
+        """same as build() but remembers packets of commands that are sent repeatedly with the same payload"""
+        return cls.build(cmd, payload)
+
+    @classmethod
+    def specialize(cls, cmd: CommandBase, payload_size: int) -> Callable[[bytes], bytes]:
+        """
+        create a builder for packets of one command with a fixed payload size
+
+        header and the checksum over it are computed only once here,
+        packets with up to one byte of payload are all built in advance
+
+        :param cmd: Command id
+        :param payload_size: size of every payload that will be passed to the builder
+        :return: function building the packet from the payload
+        """
+        if payload_size <= 1:
+            table = tuple(cls.build(cmd, bytes([value] * payload_size)) for value in range(256 ** payload_size))
+            if payload_size == 0:
+                return lambda payload: table[0]
+            return lambda payload: table[payload[0]]
+
+        header = cls.header(cmd, payload_size)
+        header_checksum = checksum(memoryview(header)[1:])
+        end = cls.END_OF_PACKET
+
+        def build(payload: bytes) -> bytes:
+            return header + payload + _TRAILER.pack((header_checksum + checksum(payload)) & 0xffff, end)
+
+        return build
 
     @staticmethod
     def __hex_checksum(checksum: int):
@@ -61,7 +102,7 @@ class Packet(PacketBase):
             data = packet[4:3+size-2]
             checksum_lo = packet[3+size-2]
             checksum_hi = packet[3+size-1]
-            checksum = ((checksum_hi & 0xff) << 8) | (checksum_lo & 0xff)
+            packet_checksum = ((checksum_hi & 0xff) << 8) | (checksum_lo & 0xff)
             end = packet[3+size]
         except IndexError:
             raise PacketParsingError("packet incomplete")
@@ -71,9 +112,9 @@ class Packet(PacketBase):
         if end != PacketBase.END_OF_PACKET:
             raise PacketParsingError(f"END_OF_PACKET value wrong: {end}")
         
-        wanted_checksum = sum(packet[1:3+size-2]) & 0xffff
-        if checksum != wanted_checksum:
-            raise PacketChecksumError(f"checksum wrong, got: {Packet.__hex_checksum(checksum)} wanted: {Packet.__hex_checksum(wanted_checksum)}")
+        wanted_checksum = checksum(memoryview(packet)[1:3+size-2])
+        if packet_checksum != wanted_checksum:
+            raise PacketChecksumError(f"checksum wrong, got: {Packet.__hex_checksum(packet_checksum)} wanted: {Packet.__hex_checksum(wanted_checksum)}")
         
         return parser.parse(cmd_type, data)
     
@@ -12,6 +12,12 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Optional, Union, Any
 
@@ -20,10 +26,24 @@ from loguru import logger
 import bluetooth_base
 import command
 import exceptions
+import image
 from packet import ResponsePacket, Packet, CommandBase
 
+# payload layouts
+_SCORE = struct.Struct("<BBHH4x")  # box mode, 0, red score, blue score
+_MUSIC_VISUALIZER = struct.Struct("<BB8x")  # box mode, visualizer
+_TIME = struct.Struct("<8B")  # year % 100, year // 100, month, day, hours, minutes, seconds, day of week
+_LIGHT_MODE_CLOCK = struct.Struct("<10B")  # box mode, 1, time type, 4 activated modes, r, g, b
+_LIGHT_MODE_LIGHT = struct.Struct("<10B")  # box mode, r, g, b, 0x14, 0, 4 activated modes
+
+# packet builders for commands with fixed payload size, by (command, payload size)
+_builders = {(cmd, size): Packet.specialize(cmd, size) for cmd, size in command.payload_size.items()}
+
 
 class Pixoo:
+    # flush collected packets before a batch grows beyond this many bytes
+    MAX_BATCH_SIZE = 512
+
     def __init__(self, bt_device: bluetooth_base.BluetoothBase):
         self.comm = bt_device
         self.comm.connect()
@@ -31,6 +51,35 @@ class Pixoo:
 
         self.command_parser = command.CommandParser()
 
+        # outgoing packets collected by batch(), None when not batching
+        self._tx_buf = None  # type: Optional[bytearray]
+
+    @contextmanager
+    def batch(self):
+        """
+        collect packets of commands without response and send them in one go when leaving the context
+
+        commands that have a response are still sent right away, after everything collected before them
+        """
+        if self._tx_buf is not None:
+            # already batching
+            yield self
+            return
+
+        self._tx_buf = bytearray()
+        try:
+            yield self
+        finally:
+            try:
+                self._flush_batch()
+            finally:
+                self._tx_buf = None
+
+    def _flush_batch(self):
+        if self._tx_buf:
+            self.comm.write(bytes(self._tx_buf))
+            self._tx_buf.clear()
+
     def write(self, data: bytes) -> Union[Optional[bytes], Any]:
         """
         send raw data to Pixoo and receive and parse response packet
@@ -38,42 +87,66 @@ class Pixoo:
         :param data: raw packet to send
         :return: ResponsePacket if this command has a response and we successfully received it
         """
+        return self._write_raw(data)
+
+    def _write_raw(self, data: bytes, validate: bool = True) -> Union[Optional[bytes], Any]:
+        """
+        like write(), validation can be skipped for packets we built ourselves
 
-        if not Packet.is_valid(self.command_parser, data):
+        :param data: raw packet to send
+        :param validate: check the packet before sending it
+        :return: ResponsePacket if this command has a response and we successfully received it
+        """
+        if validate and not Packet.is_valid(self.command_parser, data):
             raise exceptions.PacketWriteException("tried to send invalid packet")
 
+        cmd = data[3]
+        if self._tx_buf is not None:
+            if cmd in command.without_response:
+                if len(self._tx_buf) + len(data) > self.MAX_BATCH_SIZE:
+                    self._flush_batch()
+                self._tx_buf += data
+                logger.opt(lazy=True).debug("batching {}", lambda: list(data))
+                return None
+
+            # we need the response right away, send everything before it first
+            self._flush_batch()
+
         self.comm.write(data)
-        logger.debug(f"sending {list(data)}")
+        logger.opt(lazy=True).debug("sending {}", lambda: list(data))
 
-        cmd = data[3]
         if cmd in command.without_response:
             return None
 
-        # read packet start marker and packet size
-        response = self.comm.read(3)
-        if len(response) == 3:
-            if response[0] == Packet.START_OF_PACKET:
-                size_lo = response[1]
-                size_hi = response[2]
+        return self._read_response()
+
+    def _read_response(self) -> Union[Optional[bytes], Any]:
+        """
+        receive and parse the response to the last command
+
+        :return: ResponsePacket if we successfully received it
+        """
+        packet = self.comm.read_packet()
+        if len(packet) >= 3:
+            if packet[0] == Packet.START_OF_PACKET:
+                size_lo = packet[1]
+                size_hi = packet[2]
                 size = ((size_hi & 0xff) << 8) | (size_lo & 0xff)
-                logger.debug(f"receiving payload with length {size}")
+                logger.debug("receiving payload with length {}", size)
 
-                # read rest of packet
-                rest = self.comm.read(size + 1)
-                if len(rest):
-                    if rest[-1] == Packet.END_OF_PACKET:
+                if len(packet) == size + 4:
+                    if packet[-1] == Packet.END_OF_PACKET:
                         # we received a complete packet
-                        packet = response + rest
-                        logger.debug(f"received {list(packet)}")
+                        logger.opt(lazy=True).debug("received {}", lambda: list(packet))
                         return ResponsePacket.parse(self.command_parser, packet)
                     else:
-                        logger.error(f"end marker not present: rest={rest}")
+                        logger.error(f"end marker not present: packet={packet}")
                 else:
-                    logger.error("rest empty")
+                    logger.error(f"incomplete packet: {packet}")
             else:
-                logger.error(f"received garbage: {response}")
+                logger.error(f"received garbage: {packet}")
         else:
-            logger.error(f"didn't receive enough data for response, only: {response}")
+            logger.error(f"didn't receive enough data for response, only: {packet}")
 
         return None
 
@@ -86,7 +159,21 @@ class Pixoo:
         :param cmd_data: raw data, command-specific
         :return: parsed ResponsePacket if we received it successfully
         """
-        return self.write(Packet.build(cmd, cmd_data))
+        if isinstance(cmd_data, int):
+            cmd_data = bytes([cmd_data])
+        elif cmd_data is None:
+            cmd_data = b""
+        else:
+            # canonical hashable key for the packet cache, also accepts bytearray and memoryview
+            cmd_data = bytes(cmd_data)
+
+        builder = _builders.get((cmd, len(cmd_data)))
+        if builder is not None:
+            data = builder(cmd_data)
+        else:
+            data = Packet.build_cached(cmd, cmd_data)
+
+        return self._write_raw(data, validate=False)
 
     def set_brightness(self, percent: int):
         if not (0 <= percent <= 100):
@@ -95,42 +182,42 @@ class Pixoo:
         return self.write_command(command.Command.SET_SYSTEM_BRIGHTNESS, percent)
 
     def set_score(self, blue_score: int, red_score: int):
-        rs_lo = red_score & 0xff
-        rs_hi = (red_score >> 8) & 0xff
-        bs_lo = blue_score & 0xff
-        bs_hi = (blue_score >> 8) & 0xff
-        val = bytes([command.BoxMode.WATCH, 0, rs_lo, rs_hi, bs_lo, bs_hi, 0, 0, 0, 0])
+        val = _SCORE.pack(command.BoxMode.WATCH, 0, red_score & 0xffff, blue_score & 0xffff)
         return self.write_command(command.Command.SET_BOX_MODE, val)
 
     def set_music_visualizer(self, visualizer: int):
         if not (0 <= visualizer <= 11):
             raise ValueError("visualizer id out of range")
 
-        val = bytes([command.BoxMode.MUSIC, visualizer & 0xff] + [0] * 8)
+        val = _MUSIC_VISUALIZER.pack(command.BoxMode.MUSIC, visualizer)
         return self.write_command(command.Command.SET_BOX_MODE, val)
 
-    def set_time(self, ts: Optional[datetime] = None):
-        if ts is None:
-            ts = datetime.now()
+    def set_time(self, ts: Optional[datetime] = None, epoch: Optional[float] = None):
+        """
+        set the clock
 
-        year = ts.year
-        month = ts.month
-        day_of_month = ts.day
-        hours = ts.hour
-        minutes = ts.minute
-        seconds = ts.second
-        day_of_week = ts.isoweekday() % 7
+        :param ts: local time, if not given the time from epoch is used
+        :param epoch: seconds since the epoch as returned by time.time(), defaults to now
+        """
+        if ts is not None:
+            fields = (ts.year, ts.month, ts.day, ts.hour, ts.minute, ts.second, ts.weekday())
+        else:
+            # struct_time is filled in C, no need to build a datetime just to take it apart again
+            fields = time.localtime(epoch)[:7]
 
-        val = bytes([
-            int(year % 100),
-            int(year / 100),
+        full_year, month, day_of_month, hours, minutes, seconds, weekday = fields
+        century, year = divmod(full_year, 100)
+
+        val = _TIME.pack(
+            year,
+            century,
             month,  # 1 to 12
             day_of_month,  # 1 to 31
             hours,
             minutes,
             seconds,
-            day_of_week,  # 0=sun, 1=mon, ..6=sat
-        ])
+            (weekday + 1) % 7,  # 0=sun, 1=mon, ..6=sat
+        )
         return self.write_command(command.Command.SET_TIME, val)
 
     def set_game(self, enable: bool, game: int):
@@ -156,7 +243,7 @@ class Pixoo:
         if modes is None:
             modes = command.ActivatedModes.get_default()
 
-        val = bytes([
+        val = _LIGHT_MODE_CLOCK.pack(
             command.BoxMode.ENV.value,
             1,
             time_type.value,
@@ -167,7 +254,7 @@ class Pixoo:
             red,
             green,
             blue
-        ])
+        )
         return self.write_command(command.Command.SET_BOX_MODE, val)
 
     def set_light_mode_temperature(self, box_mode: command.GetBoxMode):
@@ -192,7 +279,7 @@ class Pixoo:
         if modes is None:
             modes = command.ActivatedModes.get_default()
 
-        val = bytes([
+        val = _LIGHT_MODE_LIGHT.pack(
             command.BoxMode.LIGHT.value,
             red,
             green,
@@ -203,9 +290,29 @@ class Pixoo:
             int(modes.weather),
             int(modes.temperature),
             int(modes.date)
-        ])
+        )
         return self.write_command(command.Command.SET_BOX_MODE, val)
 
+    def set_image(self, buf: image.ImageBuffer, palette: image.Palette, frame_time: int = 500):
+        """
+        show a still image
+
+        :param buf: image to send
+        :param palette: palette to encode the image with, every pixel gets the nearest color
+        :param frame_time: frame duration in ms
+        """
+        palette_data = palette.to_array().tobytes()
+        image_size = (buf.width * buf.height * palette.bits_per_pixel() + 7) // 8
+
+        # layout as seen in packets sent by the app, the length counts everything starting at 0xaa
+        size = 7 + len(palette_data) + image_size
+        val = b"\x00\x0a\x0a\x04\xaa" + struct.pack("<HHBB", size, frame_time, 0, len(palette.palette) & 0xff) + \
+            palette_data
+
+        # the image data is encoded and appended to the packet in one go, frames hardly ever repeat so no caching
+        header = Packet.header(command.Command.SET_BOX_COLOR, len(val) + image_size) + val
+        return self._write_raw(buf.encode_packet(palette, header, Packet.END_OF_PACKET), validate=False)
+
     def set_light_mode_vj(self, pattern: int):
         if pattern < 0 or pattern > 15:
             raise ValueError("pattern id out of range")
@@ -215,3 +322,69 @@ class Pixoo:
             pattern
         ])
         return self.write_command(command.Command.SET_BOX_MODE, val)
+
+
+class PipelinedPixoo(Pixoo):
+    """
+    Pixoo which doesn't block on responses: commands that have one return a Future instead.
+
+    Responses are received by a background thread so the next packets can be built and sent in the meantime.
+    The Pixoo answers in order, so responses are matched to their commands first in, first out.
+    Sending a packet and queueing its Future happen under one lock, so commands may come from several threads.
+    """
+    def __init__(self, bt_device: bluetooth_base.BluetoothBase):
+        super().__init__(bt_device)
+
+        # reentrant because _write_raw() flushes batches itself
+        self._tx_lock = threading.RLock()
+        self._closed = False
+
+        self._pending = queue.SimpleQueue()  # type: queue.SimpleQueue[Optional[Future]]
+        self._rx_thread = threading.Thread(target=self._rx_loop, name="pixoo-rx", daemon=True)
+        self._rx_thread.start()
+
+    def close(self):
+        """stop the receiver thread after all pending responses were received, no more commands can be sent"""
+        with self._tx_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._pending.put(None)
+
+        self._rx_thread.join()
+
+    def _write_raw(self, data: bytes, validate: bool = True) -> Union[Optional[bytes], Any]:
+        with self._tx_lock:
+            if self._closed:
+                raise exceptions.NotConnectedException("tried to write data after close()")
+
+            return super()._write_raw(data, validate)
+
+    def _flush_batch(self):
+        with self._tx_lock:
+            if self._closed and self._tx_buf:
+                raise exceptions.NotConnectedException("tried to write data after close()")
+
+            super()._flush_batch()
+
+    def _read_response(self) -> Future:
+        future = Future()
+        self._pending.put(future)
+        return future
+
+    def _rx_loop(self):
+        while True:
+            future = self._pending.get()
+            if future is None:
+                break
+
+            try:
+                # always read the response, even if nobody waits for it anymore, to stay in sync
+                response = super()._read_response()
+            except Exception as e:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+                continue
+
+            if future.set_running_or_notify_cancel():
+                future.set_result(response)